@@ -13,11 +13,29 @@ from __future__ import print_function
 
 import torch
 import torch.nn as nn
-from torch.autograd import Variable, grad
+from torch.autograd import grad
 import torch.nn.functional as F
 import numpy as np
 
 
+def fuse_bn(layers):
+    """Fold frozen BatchNorm layers into the preceding conv/linear layer"""
+
+    from torch.nn.utils.fusion import fuse_conv_bn_eval, fuse_linear_bn_eval
+
+    fused = []
+    for m in layers:
+        prev = fused[-1] if fused else None
+        if isinstance(m, nn.BatchNorm2d) and isinstance(prev, (nn.Conv2d, nn.ConvTranspose2d)):
+            fused[-1] = fuse_conv_bn_eval(prev, m,
+                transpose=isinstance(prev, nn.ConvTranspose2d))
+        elif isinstance(m, nn.BatchNorm1d) and isinstance(prev, nn.Linear):
+            fused[-1] = fuse_linear_bn_eval(prev, m)
+        else:
+            fused.append(m)
+    return nn.Sequential(*fused)
+
+
 class DCGAN(nn.Module):
     """
     Implementation of DCGAN
@@ -31,25 +49,58 @@ class DCGAN(nn.Module):
     """
 
     def __init__(self, gan_type='gan', latent_dim=100, batch_size=64,
-            use_cuda=True):
+            use_cuda=True, use_compile=False, use_amp=False, upsample=False):
         super(DCGAN, self).__init__()
         self.gan_type = gan_type
         self.latent_dim = latent_dim
         self.batch_size = batch_size
         self.use_cuda = use_cuda
+        self.device = 'cuda' if torch.cuda.is_available() and use_cuda else 'cpu'
+
+        # Mixed precision (bfloat16 on Ampere+ needs no loss scaling)
+        self.use_amp = use_amp and torch.cuda.is_available() and use_cuda
+        # (is_bf16_supported() is also true where bfloat16 is only emulated)
+        if self.use_amp and torch.cuda.get_device_capability() >= (8, 0):
+            self.amp_dtype = torch.bfloat16
+        else:
+            self.amp_dtype = torch.float16
 
-        self.G = Generator()
+        self.G = Generator(upsample=upsample)
         self.D = Discriminator()
         #self.G = Gen(100)
         #self.D = Disc(3)
         self.init_weights(self.G)
         self.init_weights(self.D)
 
-        self.y_real = Variable(torch.ones(batch_size))
-        self.y_fake = Variable(torch.zeros(batch_size))
-        if torch.cuda.is_available() and self.use_cuda:
-            self.y_real = self.y_real.cuda()
-            self.y_fake = self.y_fake.cuda()
+        # Fuse layers and replay fixed shapes as CUDA graphs (PyTorch 2.2+)
+        # Compiling in place keeps the checkpoint state_dict keys unchanged
+        if use_compile and hasattr(nn.Module, 'compile'):
+            self.G.compile(mode='reduce-overhead')
+            self.D.compile(mode='reduce-overhead')
+        elif use_compile:
+            print('Warning: nn.Module.compile needs PyTorch 2.2+, running uncompiled')
+
+        # Resolve losses once instead of branching at every step
+        losses = {
+            'gan': (self._G_loss_gan, self._D_loss_gan),
+            'lsgan': (self._G_loss_lsgan, self._D_loss_lsgan),
+            'wgan': (self._G_loss_wgan, self._D_loss_wgan)
+        }
+        if gan_type not in losses:
+            raise NotImplementedError
+        self._G_loss, self._D_loss = losses[gan_type]
+
+        # Let the G step reuse the samples from the preceding D step (not for
+        # WGAN, where most D steps are not followed by a G step)
+        self.reuse_fake = gan_type != 'wgan'
+        self._fake_imgs = None
+
+        # Constant targets, allocated once on the device (logits are float32)
+        # Buffers follow .to()/.cuda() but stay out of the state_dict
+        self.register_buffer('y_real', torch.ones(batch_size,
+            dtype=torch.float, device=self.device), persistent=False)
+        self.register_buffer('y_fake', torch.zeros(batch_size,
+            dtype=torch.float, device=self.device), persistent=False)
 
 
     def load_model(self, filename, use_cuda=True):
@@ -79,6 +130,14 @@ class DCGAN(nn.Module):
         torch.save(self.D.state_dict(), fname_disc_pt)
 
 
+    def fuse_for_eval(self):
+        """Fold generator BatchNorm into its layers (inference only)"""
+
+        self.G.eval()
+        self.G.linear = fuse_bn(self.G.linear)
+        self.G.features = fuse_bn(self.G.features)
+
+
     def init_weights(self, model):
         """Initialize weights and biases (according to paper)"""
 
@@ -91,111 +150,119 @@ class DCGAN(nn.Module):
     def get_num_params(self):
         """Compute the total number of parameters in model"""
 
-        num_params_D, num_params_G = 0, 0
-        for p in self.D.parameters():
-            num_params_D += p.data.view(-1).size(0)
-        for p in self.G.parameters():
-            num_params_G += p.data.view(-1).size(0)
+        num_params_D = sum(p.numel() for p in self.D.parameters())
+        num_params_G = sum(p.numel() for p in self.G.parameters())
         return num_params_D, num_params_G
 
 
     def create_latent_var(self, batch_size, seed=None):
         """Create latent variable z"""
 
+        # Seeded samples come from the CPU RNG so seeds give the same faces
+        # on any device
         if seed:
             torch.manual_seed(seed)
-        z = Variable(torch.randn(batch_size, self.latent_dim))
-        if torch.cuda.is_available() and self.use_cuda:
-            z = z.cuda()
-        return z
+            return torch.randn(batch_size, self.latent_dim).to(self.device)
+        return torch.randn(batch_size, self.latent_dim, device=self.device)
 
 
-    def train_G(self, G_optimizer, batch_size):
-        """Update generator parameters"""
-        self.G.zero_grad()
-        self.D.zero_grad()
+    def _G_loss_gan(self, D_out_fake):
+        return F.binary_cross_entropy_with_logits(D_out_fake, self.y_real)
+
+
+    def _G_loss_lsgan(self, D_out_fake):
+        return torch.mean((D_out_fake - 1) ** 2)
 
-        # Through generator, then discriminator
-        z = self.create_latent_var(self.batch_size)
-        fake_imgs = self.G(z)
-        D_out_fake = self.D(fake_imgs)
 
-        if self.gan_type == 'gan':
-            # Evaluate loss and backpropagate
-            G_train_loss = F.binary_cross_entropy_with_logits(D_out_fake, self.y_real)
-            G_train_loss.backward()
-            G_optimizer.step()
+    def _G_loss_wgan(self, D_out_fake):
+        # Negative since we minimize
+        return -D_out_fake.mean()
 
-            #  Update generator loss
-            G_loss = G_train_loss.data[0]
 
-        elif self.gan_type == 'lsgan':
-            # Evaluate loss and backpropagate (negative since we minimize)
-            G_train_loss = torch.mean((D_out_fake - 1) ** 2)
-            G_train_loss.backward()
-            G_optimizer.step()
+    def _D_loss_gan(self, D_out_real, D_out_fake):
+        D_real_loss = F.binary_cross_entropy_with_logits(D_out_real, self.y_real)
+        D_fake_loss = F.binary_cross_entropy_with_logits(D_out_fake, self.y_fake)
+        return D_real_loss + D_fake_loss
 
-            #  Update generator loss
-            G_loss = G_train_loss.data[0]
 
-        elif self.gan_type == 'wgan':
-            # Evaluate loss and backpropagate (negative since we minimize)
-            G_train_loss = -D_out_fake.mean()
-            G_train_loss.backward()
-            G_optimizer.step()
+    def _D_loss_lsgan(self, D_out_real, D_out_fake):
+        D_real_loss = torch.mean((D_out_real - 1) ** 2)
+        D_fake_loss = torch.mean(D_out_fake ** 2)
+        return D_real_loss + D_fake_loss
 
-            #  Update generator loss
-            G_loss = G_train_loss.data[0]
 
+    def _D_loss_wgan(self, D_out_real, D_out_fake):
+        # Negative since we minimize
+        return -(D_out_real.mean() - D_out_fake.mean())
 
+
+    def backward_step(self, loss, optimizer, scaler=None):
+        """Backpropagate loss and update parameters (scaled for FP16)"""
+
+        if scaler is None:
+            loss.backward()
+            optimizer.step()
         else:
-            raise NotImplementedError
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
 
+
+    def train_G(self, G_optimizer, batch_size, z=None, scaler=None):
+        """Update generator parameters"""
+        G_optimizer.zero_grad(set_to_none=True)
+        self.D.zero_grad(set_to_none=True)
+
+        # Through generator (unless reusing the last D step's samples),
+        # then discriminator
+        with torch.autocast('cuda', dtype=self.amp_dtype, enabled=self.use_amp):
+            if z is None and self._fake_imgs is not None:
+                fake_imgs, self._fake_imgs = self._fake_imgs, None
+            else:
+                if z is None:
+                    z = self.create_latent_var(self.batch_size)
+                fake_imgs = self.G(z)
+            D_out_fake = self.D(fake_imgs)
+        D_out_fake = D_out_fake.float()
+
+        # Evaluate loss and backpropagate
+        G_train_loss = self._G_loss(D_out_fake)
+        self.backward_step(G_train_loss, G_optimizer, scaler)
+
+        #  Update generator loss
+        G_loss = G_train_loss.detach()
         return G_loss
 
 
-    def train_D(self, x, D_optimizer, batch_size):
+    def train_D(self, x, D_optimizer, batch_size, z=None, scaler=None):
         """Update discriminator parameters"""
 
-        self.D.zero_grad()
+        D_optimizer.zero_grad(set_to_none=True)
 
         # Through generator, then discriminator
-        D_out_real = self.D(x)
-        z = self.create_latent_var(self.batch_size)
-        fake_imgs = self.G(z).detach()
-        D_out_fake = self.D(fake_imgs)
-
-        if self.gan_type == 'gan':
-            D_real_loss = F.binary_cross_entropy_with_logits(D_out_real, self.y_real)
-            D_fake_loss = F.binary_cross_entropy_with_logits(D_out_fake, self.y_fake)
-
-            # Update discriminator
-            D_train_loss = D_real_loss + D_fake_loss
-            D_train_loss.backward()
-            D_optimizer.step()
-
-        elif self.gan_type == 'lsgan':
-            # Update discriminator
-            D_real_loss = torch.mean((D_out_real - 1) ** 2)
-            D_fake_loss = torch.mean(D_out_fake ** 2)
-            D_train_loss = D_real_loss + D_fake_loss
-            D_train_loss.backward()
-            D_optimizer.step()
-
-        elif self.gan_type == 'wgan':
-            # Update discriminator (negative since we minimize)
-            D_train_loss = -(D_out_real.mean() - D_out_fake.mean())
-            D_train_loss.backward()
-            D_optimizer.step()
-
-            # Clip weights
+        if z is None:
+            z = self.create_latent_var(self.batch_size)
+        with torch.autocast('cuda', dtype=self.amp_dtype, enabled=self.use_amp):
+            D_out_real = self.D(x)
+            G_out = self.G(z)
+            fake_imgs = G_out.detach()
+            D_out_fake = self.D(fake_imgs)
+        D_out_real, D_out_fake = D_out_real.float(), D_out_fake.float()
+
+        # Update discriminator
+        D_train_loss = self._D_loss(D_out_real, D_out_fake)
+        self.backward_step(D_train_loss, D_optimizer, scaler)
+
+        # Clip weights
+        if self.gan_type == 'wgan':
             self.D.clip()
 
-        else:
-            raise NotImplementedError
+        # Keep the samples with their generator graph for the next G step
+        if self.reuse_fake:
+            self._fake_imgs = G_out
 
-        # Update discriminator loss
-        D_loss = D_train_loss.data[0]
+        # Update discriminator loss (kept on device, no sync)
+        D_loss = D_train_loss.detach()
         return D_loss, fake_imgs
 
 
@@ -213,9 +280,16 @@ class DCGAN(nn.Module):
 class Generator(nn.Module):
     """DCGAN Generator G(z)"""
 
-    def __init__(self, latent_dim=100):
+    def __init__(self, latent_dim=100, upsample=False):
         super(Generator, self).__init__()
 
+        def up(in_dim, out_dim):
+            # Nearest upsampling + conv avoids transposed conv checkerboards
+            if upsample:
+                return [nn.Upsample(scale_factor=2, mode='nearest'),
+                    nn.Conv2d(in_dim, out_dim, 3, 1, 1, bias=False)]
+            return [nn.ConvTranspose2d(in_dim, out_dim, 4, 2, 1, bias=False)]
+
         # Project and reshape
         self.linear = nn.Sequential(
             nn.Linear(latent_dim, 512 * 4 * 4, bias=False),
@@ -224,16 +298,16 @@ class Generator(nn.Module):
 
         # Upsample
         self.features = nn.Sequential(
-            nn.ConvTranspose2d(512, 256, kernel_size=4, stride=2, padding=1, bias=False),
+            *up(512, 256),
             nn.BatchNorm2d(256),
             nn.ReLU(inplace=True),
-            nn.ConvTranspose2d(256, 128, 4, 2, 1, bias=False),
+            *up(256, 128),
             nn.BatchNorm2d(128),
             nn.ReLU(inplace=True),
-            nn.ConvTranspose2d(128, 64, 4, 2, 1, bias=False),
+            *up(128, 64),
             nn.BatchNorm2d(64),
             nn.ReLU(inplace=True),
-            nn.ConvTranspose2d(64, 3, 4, 2, 1, bias=False),
+            *up(64, 3),
             nn.Tanh())
         """
         self.features = nn.Sequential(
@@ -291,6 +365,9 @@ class Discriminator(nn.Module):
             nn.Conv2d(512, 1, 4, bias=False))
         """
 
+        # Parameters to clip at every critic step (WGAN)
+        self._params = list(self.features.parameters())
+
     def forward(self, x):
         return self.features(x).view(-1)
 
@@ -298,8 +375,9 @@ class Discriminator(nn.Module):
     def clip(self, c=0.05):
         """Weight clipping in (-c, c)"""
 
-        for p in self.parameters():
-            p.data.clamp_(-c, c)
+        with torch.no_grad():
+            for p in self._params:
+                p.clamp_(-c, c)
 
 
 class Disc(nn.Module):
@@ -8,7 +8,6 @@ from __future__ import print_function
 
 import torch
 import torch.nn as nn
-from torch.autograd import Variable
 import torch.optim as optim
 from dcgan import DCGAN, Generator, Discriminator
 import torchvision.utils
@@ -68,10 +67,9 @@ def inception_score(imgs, cuda=True, batch_size=32, resize=False, splits=1):
 
     for i, (batch,_) in enumerate(dataloader, 0):
         batch = batch.type(dtype)
-        batchv = Variable(batch)
         batch_size_i = batch.size()[0]
 
-        preds[i*batch_size:i*batch_size + batch_size_i] = get_pred(batchv)
+        preds[i*batch_size:i*batch_size + batch_size_i] = get_pred(batch)
 
     # Now compute the mean kl-div
     split_scores = []
@@ -127,17 +125,15 @@ def mode_score(imgs, real_imgs, cuda=True, batch_size=32, resize=False, splits=1
 
     for i, (batch,_) in enumerate(dataloader, 0):
         batch = batch.type(dtype)
-        batchv = Variable(batch)
         batch_size_i = batch.size()[0]
 
-        preds_gen[i*batch_size:i*batch_size + batch_size_i] = get_pred(batchv)
+        preds_gen[i*batch_size:i*batch_size + batch_size_i] = get_pred(batch)
 
     for i, (batch,_) in enumerate(real_imgs, 0):
-        batch = batch.type(dtype)
-        batchv = Variable(batch)
+        batch = utils.normalize(batch).type(dtype)
         batch_size_i = batch.size()[0]
 
-        preds_real[i*batch_size:i*batch_size + batch_size_i] = get_pred(batchv)
+        preds_real[i*batch_size:i*batch_size + batch_size_i] = get_pred(batch)
 
     # Now compute the mean kl-div
     split_scores = []
@@ -13,10 +13,8 @@ from __future__ import print_function
 
 import torch
 import torch.nn as nn
-from torch.autograd import Variable
 import torch.nn.functional as F
 import torchvision.utils
-import numpy as np
 import argparse
 import os
 import subprocess as sp
@@ -32,26 +30,46 @@ Good random seeds for GAN:
 """
 
 
+def lerp_weights(x, nb_frames):
+    """Interpolation weights i / nb_frames, shaped to broadcast over x"""
+
+    alphas = torch.arange(nb_frames, device=x.device).float().div_(nb_frames)
+    return alphas.view(-1, *([1] * (x.dim() - 1)))
+
+
 def latent_lerp(gan, z0, z1, nb_frames):
     """Interpolate between two images in latent space"""
 
-    imgs = []
-    for i in range(nb_frames):
-        alpha = i / nb_frames
-        z = (1 - alpha) * z0 + alpha * z1
-        imgs.append(gan.generate_img(z))
-    return imgs
+    # Generate all frames in a single batched forward pass
+    z = torch.lerp(z0, z1, lerp_weights(z0, nb_frames))
+    return gan.generate_img(z).split(1)
 
 
 def screen_lerp(x0, x1, nb_frames):
-    """Interpolate between two images in latent space"""
+    """Interpolate between two images in screen space"""
+
+    return torch.lerp(x0, x1, lerp_weights(x0, nb_frames)).split(1)
+
+
+def save_video(imgs, out_dir):
+    """Pipe frames straight to FFmpeg (MP4), then convert to GIF"""
 
-    imgs = []
-    for i in range(nb_frames):
-        alpha = i / nb_frames
-        x = (1 - alpha) * x0 + alpha * x1
-        imgs.append(x)
-    return imgs
+    # Same uint8 conversion as torchvision.utils.save_image, done once
+    frames = imgs.mul(255).add_(0.5).clamp_(0, 255).permute(0, 2, 3, 1)
+    frames = frames.to('cpu', torch.uint8).numpy()
+    h, w = frames.shape[1:3]
+
+    video_dir = os.path.join(out_dir, 'video')
+    if not os.path.isdir(video_dir):
+        os.mkdir(video_dir)
+    mp4 = os.path.join(video_dir, 'anim.mp4')
+    gif = os.path.join(video_dir, 'anim.gif')
+
+    mk_mp4 = 'ffmpeg -y -f rawvideo -pix_fmt rgb24 -s {}x{} -i - {}'.format(w, h, mp4)
+    sp.run(mk_mp4.split(), input=frames.tobytes(), stderr=sp.DEVNULL, stdout=sp.DEVNULL,
+        check=True)
+    mk_gif = 'ffmpeg -y -i {} -pix_fmt rgb24 {}'.format(mp4, gif)
+    sp.run(mk_gif.split(), stderr=sp.DEVNULL, stdout=sp.DEVNULL, check=True)
 
 
 if __name__ == '__main__':
@@ -61,6 +79,8 @@ if __name__ == '__main__':
     parser.add_argument('-gpu', '--cuda', help='use cuda', action='store_true')
     parser.add_argument('-t', '--type', help='model type: gan | wgan | lsgan)',
         action='store', choices=['gan', 'wgan', 'lsgan'], default='gan', type=str)
+    parser.add_argument('-u', '--upsample', help='generator was trained with --upsample',
+        action='store_true')
     parser.add_argument('-p', '--pretrained',
         help='load pretrained model (generator only)', metavar='PATH')
     parser.add_argument('-d', '--dir', help='output directory for interpolation/latent play',
@@ -78,12 +98,15 @@ if __name__ == '__main__':
     args = parser.parse_args()
 
     # Compile GAN and load model (either on CPU or GPU)
-    gan = DCGAN(gan_type=args.type, use_cuda=args.cuda)
+    gan = DCGAN(gan_type=args.type, use_cuda=args.cuda, upsample=args.upsample)
     gan.eval()
     if torch.cuda.is_available() and args.cuda:
         gan = gan.cuda()
     gan.load_model(filename=args.pretrained, use_cuda=args.cuda)
 
+    # Generator is frozen, so BatchNorm can be folded into the convolutions
+    gan.fuse_for_eval()
+
     # Make directory if it doesn't exist yet
     if not os.path.isdir(args.dir):
         os.mkdir(args.dir)
@@ -104,37 +127,30 @@ if __name__ == '__main__':
             x1 = gan.generate_img(z1)
             imgs = screen_lerp(x0, x1, args.nb_frames)
 
-        # Save files
-        for i, img in enumerate(imgs):
-            img = utils.unnormalize(img)
-            fname_in = '{}/frame{:d}.png'.format(args.dir, i)
-            torchvision.utils.save_image(img, fname_in, padding=0)
-            # Generate frames for perfect looping
-            if args.video:
-                fname_out = "{}/frame{:d}.png".format(args.dir, 2*args.nb_frames - i - 1)
-                torchvision.utils.save_image(img, fname_out, padding=0)
-        print("Interpolated {} images saved in {}".format(args.nb_frames, args.dir))
-
-        # Make video
+        # Save all frames side by side in a single image
+        imgs = utils.unnormalize(torch.cat(imgs))
+        fname_in = '{}/{}_lerp.png'.format(args.dir, space)
+        torchvision.utils.save_image(imgs, fname_in, nrow=args.nb_frames, padding=0)
+        print("Interpolated {} images saved in {}".format(args.nb_frames, fname_in))
+
+        # Make video (play backwards for perfect looping)
         if args.video:
-            mk_video = './make_anim.sh {} {}'.format(args.dir, args.nb_frames)
-            sp.call(mk_video.split(), stderr=sp.DEVNULL, stdout=sp.DEVNULL)
+            save_video(torch.cat([imgs, imgs.flip(0)]), args.dir)
             print("Interpolation video saved in {}".format(os.path.join(args.dir, 'video')))
 
     if args.latent_play:
-        torch.manual_seed(args.latent_play)
-        z0 = gan.create_latent_var(1)
+        z0 = gan.create_latent_var(1, args.latent_play)
         img = gan.generate_img(z0)
         fname_in = '{}/dim_og.png'.format(args.dir)
         img = utils.unnormalize(img)
         torchvision.utils.save_image(img, fname_in, padding=0)
-        for i in range(100):
-            z1 = z0.clone()
-            z = z1[0, i].data[0]
-            print(z)
-            z1[0, i] = -np.sign(z) * 3
-            print('i={:2d}, z={:2.4f}'.format(i, z))
-            img = gan.generate_img(z1)
-            img = utils.unnormalize(img)
+
+        # Clamp one dimension per sample and generate them all in one batch
+        dims = torch.arange(gan.latent_dim, device=z0.device)
+        z1 = z0.repeat(gan.latent_dim, 1)
+        z1[dims, dims] = -torch.sign(z0[0]) * 3
+        imgs = utils.unnormalize(gan.generate_img(z1))
+        for i in range(gan.latent_dim):
+            print('i={:2d}, z={:2.4f}'.format(i, z0[0, i].item()))
             fname_in = '{}/dim{:d}.png'.format(args.dir, i)
-            torchvision.utils.save_image(img, fname_in, padding=0)
+            torchvision.utils.save_image(imgs[i], fname_in, padding=0)
@@ -13,18 +13,15 @@ from __future__ import print_function
 
 import torch
 import torch.nn as nn
-from torch.autograd import Variable
 import torch.optim as optim
 from dcgan import DCGAN, Generator, Discriminator
 import torchvision.utils
 
 import numpy as np
+import copy
 import pickle
 import glob, os, sys
-import datetime
-import matplotlib
-matplotlib.use('agg')
-import matplotlib.pyplot as plt
+import time
 import utils
 import subprocess as sp
 import argparse
@@ -43,6 +40,10 @@ class CelebA(object):
         self.momentum = train_params['momentum']
         self.optim = train_params['optim']
         self.use_cuda = train_params['use_cuda']
+        self.use_compile = train_params['use_compile']
+        self.use_amp = train_params['use_amp']
+        self.use_cuda_graph = train_params['use_cuda_graph'] and \
+            torch.cuda.is_available() and self.use_cuda
 
         # Checkpoint parameters (when, where)
         self.batch_report_interval = ckpt_params['batch_report_interval']
@@ -59,6 +60,7 @@ class CelebA(object):
         self.gan_type = gan_params['gan_type']
         self.latent_dim = gan_params['latent_dim']
         self.n_critic = gan_params['n_critic']
+        self.upsample = gan_params['upsample']
 
         # Make sure report interval divides total num of batches
         self.num_batches = self.train_len // self.batch_size
@@ -72,22 +74,32 @@ class CelebA(object):
 
         # Create new GAN
         self.gan = DCGAN(self.gan_type, self.latent_dim, self.batch_size,
-            self.use_cuda)
+            self.use_cuda, self.use_compile, self.use_amp, self.upsample)
+
+        # Loss scaling is only needed for FP16 (no-op when disabled)
+        use_scaler = self.gan.use_amp and self.gan.amp_dtype == torch.float16
+        if use_scaler and self.use_cuda_graph:
+            raise ValueError('FP16 loss scaling syncs with the host and cannot be captured in a CUDA graph')
+        self.G_scaler = torch.amp.GradScaler('cuda', enabled=use_scaler)
+        self.D_scaler = torch.amp.GradScaler('cuda', enabled=use_scaler)
+
+        # Optimizer steps must stay on device to be captured in a CUDA graph
+        capturable = {'capturable': True} if self.use_cuda_graph else {}
 
         # Set optimizers for generator and discriminator
         if self.optim == 'adam':
             self.G_optimizer = optim.Adam(self.gan.G.parameters(),
                 lr=self.learning_rate,
-                betas=self.momentum)
+                betas=self.momentum, **capturable)
             self.D_optimizer = optim.Adam(self.gan.D.parameters(),
                 lr=self.learning_rate,
-                betas=self.momentum)
+                betas=self.momentum, **capturable)
 
         elif self.optim == 'rmsprop':
             self.G_optimizer = optim.RMSprop(self.gan.G.parameters(),
-                lr=self.learning_rate)
+                lr=self.learning_rate, **capturable)
             self.D_optimizer = optim.RMSprop(self.gan.D.parameters(),
-                lr=self.learning_rate)
+                lr=self.learning_rate, **capturable)
 
         else:
             raise NotImplementedError
@@ -95,12 +107,62 @@ class CelebA(object):
         # CUDA support
         if torch.cuda.is_available() and self.use_cuda:
             self.gan = self.gan.cuda()
+            # NHWC layout lets cuDNN pick tensor core convolution kernels
+            self.gan = self.gan.to(memory_format=torch.channels_last)
 
         # Create fixed latent variables for inference while training
         self.latent_vars = []
         for i in range(100):
             self.latent_vars.append(self.gan.create_latent_var(1))
 
+        # Replay whole training steps instead of launching kernels one by one
+        if self.use_cuda_graph:
+            self.capture_graphs()
+
+
+    def capture_graphs(self):
+        """Capture discriminator/generator updates as CUDA graphs"""
+
+        # Static inputs, refilled in place before every replay
+        self.x_static = torch.randn(self.batch_size, 3, 64, 64, device='cuda')
+        self.x_static = self.x_static.contiguous(memory_format=torch.channels_last)
+        self.z_static = torch.randn(self.batch_size, self.latent_dim, device='cuda')
+
+        # Both graphs read z from the static buffer instead
+        self.gan.reuse_fake = False
+
+        # Warmup steps update the weights, so keep a copy to rewind to
+        init_state = copy.deepcopy(self.gan.state_dict())
+
+        # Warm up on a side stream to allocate gradients and optimizer state
+        s = torch.cuda.Stream()
+        s.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(s):
+            for _ in range(3):
+                self.gan.train_D(self.x_static, self.D_optimizer, self.batch_size,
+                    self.z_static, self.D_scaler)
+                self.gan.train_G(self.G_optimizer, self.batch_size,
+                    self.z_static, self.G_scaler)
+        torch.cuda.current_stream().wait_stream(s)
+
+        # Rewind in place since graphs are bound to tensor addresses
+        self.gan.load_state_dict(init_state)
+        for optimizer in [self.D_optimizer, self.G_optimizer]:
+            for state in optimizer.state.values():
+                for v in state.values():
+                    if torch.is_tensor(v):
+                        v.zero_()
+
+        # Capture both updates separately so G steps can be skipped (critic)
+        self.D_graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self.D_graph):
+            self.D_loss_static, _ = self.gan.train_D(self.x_static,
+                self.D_optimizer, self.batch_size, self.z_static, self.D_scaler)
+        self.G_graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self.G_graph):
+            self.G_loss_static = self.gan.train_G(self.G_optimizer,
+                self.batch_size, self.z_static, self.G_scaler)
+
 
     def save_stats(self, stats):
         """Save model statistics"""
@@ -120,16 +182,16 @@ class CelebA(object):
         # Montage size (square)
         m = int(np.sqrt(n))
 
-        # Predict images to see progress
+        # Predict images to see progress, as a single batch
+        # Reuse fixed latent variables to keep random process intact
+        if while_training:
+            imgs = self.gan.generate_img(torch.cat(self.latent_vars[:n]))
+        else:
+            imgs = self.gan.generate_img(n=n)
+        imgs = utils.unnormalize(imgs)
         for i in range(n):
-            # Reuse fixed latent variables to keep random process intact
-            if while_training:
-                img = self.gan.generate_img(self.latent_vars[i])
-            else:
-                img = self.gan.generate_img()
-            img = utils.unnormalize(img.squeeze())
             fname_in = '{}/test{:d}.png'.format(self.ckpt_path, i)
-            torchvision.utils.save_image(img, fname_in)
+            torchvision.utils.save_image(imgs[i], fname_in)
         stack = 'montage {}/test* -tile {}x{} -geometry 64x64+1+1 \
             {}/epoch'.format(self.ckpt_path, m, m, self.ckpt_path)
         stack = stack + str(epoch + 1) + '.png' if epoch is not None else stack + '.png'
@@ -144,17 +206,19 @@ class CelebA(object):
         # Initialize tracked quantities and prepare everything
         G_all_losses, D_all_losses, times = [], [], utils.AvgMeter()
         utils.format_hdr(self.gan, self.root_dir, self.train_len)
-        start = datetime.datetime.now()
+        start = time.perf_counter()
 
         g_iter, d_iter = 0, 0
+        dec = len(str(self.num_batches))
 
         # Train
         for epoch in range(nb_epochs):
             print('EPOCH {:d} / {:d}'.format(epoch + 1, nb_epochs))
             G_losses, D_losses = utils.AvgMeter(), utils.AvgMeter()
-            start_epoch = datetime.datetime.now()
+            G_loss_avg, D_loss_avg = 0., 0.
+            start_epoch = time.perf_counter()
 
-            avg_time_per_batch = utils.AvgMeter()
+            avg_time_per_batch = utils.BatchTimer(self.use_cuda)
             # Mini-batch SGD
             for batch_idx, (x, _) in enumerate(data_loader):
 
@@ -167,42 +231,62 @@ class CelebA(object):
                 # Training mode
                 self.gan.G.train()
 
+                # Encoded batches (--gpu-decode) are decoded on the device
+                if isinstance(x, list):
+                    x = utils.decode_batch(x, self.gan.device)
+
                 # Discard last examples to simplify code
                 if x.size(0) != self.batch_size:
                     break
-                batch_start = datetime.datetime.now()
 
                 # Print progress bar
                 utils.progress_bar(batch_idx, self.batch_report_interval,
-                    G_losses.avg, D_losses.avg)
+                    G_loss_avg, D_loss_avg)
 
-                x = Variable(x)
+                # Batches arrive as uint8, normalize on the device
                 if torch.cuda.is_available() and self.use_cuda:
-                    x = x.cuda()
+                    x = utils.normalize(x.cuda(non_blocking=True))
+                    x = x.contiguous(memory_format=torch.channels_last)
+                else:
+                    x = utils.normalize(x)
 
                 # Update discriminator
-                D_loss, fake_imgs = self.gan.train_D(x, self.D_optimizer, self.batch_size)
-                D_losses.update(D_loss, self.batch_size)
+                if self.use_cuda_graph:
+                    self.x_static.copy_(x)
+                    self.z_static.normal_()
+                    self.D_graph.replay()
+                    D_loss = self.D_loss_static
+                else:
+                    D_loss, fake_imgs = self.gan.train_D(x, self.D_optimizer,
+                        self.batch_size, scaler=self.D_scaler)
+                D_losses.update_tensor(D_loss)
                 d_iter += 1
 
                 # Update generator
                 if batch_idx % n_critic == 0:
-                    G_loss = self.gan.train_G(self.G_optimizer, self.batch_size)
-                    G_losses.update(G_loss, self.batch_size)
+                    if self.use_cuda_graph:
+                        self.z_static.normal_()
+                        self.G_graph.replay()
+                        G_loss = self.G_loss_static
+                    else:
+                        G_loss = self.gan.train_G(self.G_optimizer,
+                            self.batch_size, scaler=self.G_scaler)
+                    G_losses.update_tensor(G_loss)
                     g_iter += 1
 
-                batch_end = datetime.datetime.now()
-                batch_time = int((batch_end - batch_start).total_seconds() * 1000)
-                avg_time_per_batch.update(batch_time)
+                avg_time_per_batch.update()
 
                 # Report model statistics
                 if (batch_idx % self.batch_report_interval == 0 and batch_idx) or \
                     self.batch_report_interval == self.num_batches:
-                    G_all_losses.append(G_losses.avg)
-                    D_all_losses.append(D_losses.avg)
-                    utils.show_learning_stats(batch_idx, self.num_batches, G_losses.avg, D_losses.avg, avg_time_per_batch.avg)
-                    [k.reset() for k in [G_losses, D_losses, avg_time_per_batch]]
+                    # Losses are summed on the GPU, only sync here
+                    G_loss_avg, D_loss_avg = float(G_losses.avg), float(D_losses.avg)
+                    G_all_losses.append(G_loss_avg)
+                    D_all_losses.append(D_loss_avg)
+                    utils.show_learning_stats(batch_idx, self.num_batches, G_loss_avg, D_loss_avg, avg_time_per_batch.avg, dec)
+                    [k.reset() for k in [G_losses, D_losses]]
                     self.eval(100, epoch=epoch, while_training=True)
+                    avg_time_per_batch.reset()
                     # print('Critic iter: {}'.format(g_iter))
 
                 # Save stats
@@ -241,15 +325,29 @@ if __name__ == '__main__':
         default=64, type=int)
     parser.add_argument('-n', '--nb-epochs', help='number of epochs', default=10, type=int)
     parser.add_argument('-c', '--critic', help='d/g update ratio (critic)', default=1, type=int)
+    parser.add_argument('-u', '--upsample', help='upsample + conv generator (no transposed conv)',
+        action='store_true')
     parser.add_argument('-s', '--seed', help='random seed for debugging', type=int)
+    parser.add_argument('--cache', help='decoded image cache (built on first use)',
+        metavar='PATH')
+    parser.add_argument('--gpu-decode', help='decode JPEG batches on the GPU (nvJPEG)',
+        action='store_true')
     parser.add_argument('-gpu', '--cuda', help='use cuda', action='store_true')
+    parser.add_argument('--amp', help='mixed precision training (bfloat16 or float16)',
+        action='store_true')
+    accel = parser.add_mutually_exclusive_group()
+    accel.add_argument('--compile', help='compile generator/discriminator with torch.compile',
+        action='store_true')
+    accel.add_argument('--cuda-graph', help='replay training steps as CUDA graphs',
+        action='store_true')
     args = parser.parse_args()
 
     # GAN parameters (type and latent dimension size)
     gan_params = {
         'gan_type': args.type,
         'latent_dim': 100,
-        'n_critic': args.critic
+        'n_critic': args.critic,
+        'upsample': args.upsample
     }
 
     # Training parameters (saving directory, learning rate, optimizer, etc.)
@@ -261,7 +359,10 @@ if __name__ == '__main__':
         'learning_rate': args.learning_rate,
         'momentum': (0.5, 0.999),
         'optim': args.optimizer,
-        'use_cuda': args.cuda
+        'use_cuda': args.cuda,
+        'use_compile': args.compile,
+        'use_amp': args.amp,
+        'use_cuda_graph': args.cuda_graph
     }
 
     # Checkpoint parameters (report interval size, directories)
@@ -271,10 +372,20 @@ if __name__ == '__main__':
         'save_stats_interval': 500
     }
 
+    # Decode the image cache first, before any model (or graph) setup
+    if args.cache and not os.path.isfile(args.cache):
+        utils.build_tensor_cache(train_params['root_dir'], args.cache)
+
+    # Input shapes are fixed, so let cuDNN benchmark its (NHWC) algorithms
+    # (set before CelebA, which may capture CUDA graphs)
+    if args.cuda:
+        torch.backends.cudnn.benchmark = True
+
     # Ready to train
     model = CelebA(train_params, ckpt_params, gan_params)
     data_loader = utils.load_dataset(train_params['root_dir'],
-        train_params['batch_size'])
+        train_params['batch_size'], cache_path=args.cache,
+        gpu_decode=args.gpu_decode)
 
     if args.seed:
         torch.manual_seed(args.seed)
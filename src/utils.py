@@ -15,118 +15,290 @@ import torch
 import torch.nn as nn
 from torchvision import transforms
 from torchvision.datasets import ImageFolder
+from torchvision.io import read_file, decode_image, decode_jpeg, ImageReadMode
 from torch.utils.data import Dataset, DataLoader, TensorDataset
 
-import matplotlib
-matplotlib.use('agg')
-from matplotlib import rcParams
-rcParams['font.family'] = 'sans-serif'
-rcParams['font.sans-serif'] = ['Arial']
-import matplotlib.pyplot as plt
 import numpy as np
-import datetime
+import hashlib
+import time
+import os
+import sys
+
+# Optional fused kernel for the CPU normalize path
+try:
+    from numba import njit, prange
+except ImportError:
+    _normalize_u8 = None
+else:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _normalize_u8(x, lut, out):
+        """out[n, c] = lut[c, x[n, c]], x is (N, C, H * W) uint8"""
+        for n in prange(x.shape[0]):
+            for c in range(x.shape[1]):
+                for p in range(x.shape[2]):
+                    out[n, c, p] = lut[c, x[n, c, p]]
+
+
+# Normalization statistics, data is mapped to [-1, 1]
+# (CelebA: mean = [0.5066, 0.4261, 0.3836], std = [0.2589, 0.2380, 0.2340])
+MEAN, STD = [0.5] * 3, [0.5] * 3
+# Normalized value of every uint8 intensity, per channel (CPU lookup table)
+_LUT = ((np.arange(256) / 255. - np.array(MEAN)[:, None]) /
+        np.array(STD)[:, None]).astype(np.float32)
+_affine, _inverse = {}, {}
+
+# Progress bar: sliding window over a fixed template
+_BAR_SIZE = 24
+_BAR = '=' * _BAR_SIZE + ' ' * _BAR_SIZE
+
+# Training header
+_SEP, _SEP2 = 80 * '-', 80 * '='
+_TITLE = 'Generative Adversarial Network (GAN)'.center(80)
+# GAN type -> (name, objective)
+_GAN_TYPES = {
+    'gan': ('Deep convolutional GAN (DCGAN)',
+        'min_G max_D  E_x[log D(x)] + E_z[log (1 - D(G(z)))]'),
+    'wgan': ('Wasserstein GAN (WGAN)',
+        'min_G max_D  E_x[D(x)] - E_z[D(G(z))]'),
+    'lsgan': ('Least Squares GAN (LSGAN)',
+        'min_G max_D  E_x[(D(x) - 1)^2] - E_z[D(G(z))^2]')
+}
 
 
 def clear_line():
     """Clear line from any characters"""
-    print('\r{}'.format(' ' * 80), end='\r')
+    sys.stdout.write('\x1b[2K\r')
 
 
 def format_hdr(gan, root_dir, training_len):
     """Print type of GAN with number of parameters"""
 
     num_params_D, num_params_G = gan.get_num_params()
-    if gan.gan_type == 'gan':
-        gan_type = 'Deep convolutional GAN (DCGAN)'
-        gan_loss = 'min_G max_D  E_x[log D(x)] + E_z[log (1 - D(G(z)))]'
-    elif gan.gan_type == 'wgan':
-        gan_type = 'Wasserstein GAN (WGAN)'
-        gan_loss = 'min_G max_D  E_x[D(x)] - E_z[D(G(z))]'
-    elif gan.gan_type == 'lsgan':
-        gan_type = 'Least Squares GAN (LSGAN)'
-        gan_loss = 'min_G max_D  E_x[(D(x) - 1)^2] - E_z[D(G(z))^2]'
-    else:
-
-        gan_type = 'Unknown'
-        gan_loss = 'Unknown'
-    title = 'Generative Adversarial Network (GAN)'.center(80)
-    sep, sep_ = 80 * '-', 80 * '='
-    type_str = 'Type: {}'.format(gan_type)
-    loss_str = 'Loss: {}'.format(gan_loss)
-    param_D_str = 'Nb of generator params: {:,}'.format(num_params_D)
-    param_G_str = 'Nb of discriminator params: {:,}'.format(num_params_G)
-    dataset = 'Training on CelebA dataset ({}) with {:,} faces'.format(root_dir, training_len)
-    hdr = '\n'.join([sep_, title, sep, dataset, type_str, loss_str, param_G_str, param_D_str, sep_])
-    print(hdr)
+    gan_type, gan_loss = _GAN_TYPES.get(gan.gan_type, ('Unknown', 'Unknown'))
+    print(f'{_SEP2}\n{_TITLE}\n{_SEP}\n'
+          f'Training on CelebA dataset ({root_dir}) with {training_len:,} faces\n'
+          f'Type: {gan_type}\n'
+          f'Loss: {gan_loss}\n'
+          f'Nb of generator params: {num_params_G:,}\n'
+          f'Nb of discriminator params: {num_params_D:,}\n'
+          f'{_SEP2}')
 
 
 def time_elapsed_since(start):
-    """Compute elapsed time since start"""
+    """Compute elapsed time since start (a time.perf_counter() value)"""
 
-    end = datetime.datetime.now()
-    return str(end - start)[:-7]
+    m, s = divmod(int(time.perf_counter() - start), 60)
+    h, m = divmod(m, 60)
+    return '{:d}:{:02d}:{:02d}'.format(h, m, s)
 
 
-def progress_bar(batch_idx, report_interval, G_loss, D_loss):
+def progress_bar(batch_idx, report_interval, G_loss, D_loss, flush_every=10):
     """Neat progress bar to track training"""
 
-    bar_size = 24
     progress = (((batch_idx - 1) % report_interval) + 1) / report_interval
-    fill = int(progress * bar_size)
-    print('\rBatch {:>4d} [{}{}] G loss: {:>7.4f} | D loss: {:>7.4f}'.format(batch_idx, '=' * fill, ' ' * (bar_size - fill), G_loss, D_loss), end='')
+    fill = int(progress * _BAR_SIZE)
+    bar = _BAR[_BAR_SIZE - fill:2 * _BAR_SIZE - fill]
+    sys.stdout.write(f'\rBatch {batch_idx:>4d} [{bar}] G loss: {G_loss:>7.4f} | D loss: {D_loss:>7.4f}')
+    if batch_idx % flush_every == 0:
+        sys.stdout.flush()
 
 
-def show_learning_stats(batch_idx, num_batches, g_loss, d_loss, elapsed):
-    """Format stats"""
+def show_learning_stats(batch_idx, num_batches, g_loss, d_loss, elapsed, dec=None):
+    """Format stats (dec: batch index width, computed if not given)"""
 
     clear_line()
-    dec = str(int(np.ceil(np.log10(num_batches))))
-    print('Batch {:>{dec}d} / {:d} | G loss: {:>7.4f} | D loss: {:>7.4f} | Avg time / batch: {:d} ms'.format(batch_idx, num_batches, g_loss, d_loss, int(elapsed), dec=dec))
-
-
-def compute_mean_std(data_loader):
-    """Compute mean and standard deviation for a given dataset"""
-
-    means, stds = torch.zeros(3), torch.zeros(3)
-    for batch_idx, (x, y) in enumerate(train_loader):
-        x = x.squeeze(0)
-        means += torch.Tensor([torch.mean(x[i]) for i in range(3)])
-        stds += torch.Tensor([torch.std(x[i]) for i in range(3)])
+    if dec is None:
+        dec = len(str(num_batches))
+    print(f'Batch {batch_idx:>{dec}d} / {num_batches:d} | G loss: {g_loss:>7.4f} | D loss: {d_loss:>7.4f} | Avg time / batch: {int(elapsed):d} ms')
+
+
+def dataset_fingerprint(root_dir):
+    """Hash of an image folder's location, file listing, sizes and mtimes"""
+
+    h = hashlib.sha1(os.path.abspath(root_dir).encode())
+    for dirpath, _, files in sorted(os.walk(root_dir)):
+        for f in sorted(files):
+            path = os.path.join(dirpath, f)
+            st = os.stat(path)
+            h.update('{}:{}:{}'.format(path, st.st_size, st.st_mtime_ns).encode())
+    return h.hexdigest()[:16]
+
+
+def compute_mean_std(data_loader, use_cuda=True, root_dir=None,
+        cache_dir='~/.cache/celeba-gan'):
+    """Compute mean and standard deviation for a given dataset
+    (stored in cache_dir and reused when root_dir is given)"""
+
+    if root_dir is not None:
+        cache_path = os.path.join(os.path.expanduser(cache_dir),
+            'mean_std_{}.npz'.format(dataset_fingerprint(root_dir)))
+        if os.path.isfile(cache_path):
+            with np.load(cache_path) as stats:
+                return torch.from_numpy(stats['mean']), torch.from_numpy(stats['std'])
+
+    # Float64 sums of x and x^2 per channel give the exact global statistics
+    # (uint8 values and their squares are exact in float32, scaled at the end)
+    device = 'cuda' if use_cuda and torch.cuda.is_available() else 'cpu'
+    sums = torch.zeros(3, dtype=torch.float64, device=device)
+    sq_sums, n_pix = torch.zeros_like(sums), 0
+    for batch_idx, (x, y) in enumerate(data_loader):
+        x = x.to(device, non_blocking=True).float().view(x.size(0), 3, -1)
+        sums += x.sum((0, 2), dtype=torch.float64)
+        sq_sums += x.square().sum((0, 2), dtype=torch.float64)
+        n_pix += x.size(0) * x.size(2)
         if batch_idx % 1000 == 0 and batch_idx:
             print('{:d} images processed'.format(batch_idx))
 
-    mean = torch.div(means, len(data_loader.dataset))
-    std = torch.div(stds, len(data_loader.dataset))
+    mean = sums / (255 * n_pix)
+    std = (sq_sums / (255 ** 2 * n_pix) - mean * mean).clamp_min_(0).sqrt_()
+    mean, std = torch.stack((mean, std)).float().cpu()
     print('Mean = {}\nStd = {}'.format(mean.tolist(), std.tolist()))
+    if root_dir is not None:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        np.savez(cache_path, mean=mean.numpy(), std=std.numpy())
     return mean, std
 
 
-def load_dataset(root_dir, batch_size):
-    """Load data from image folder"""
+def build_tensor_cache(root_dir, out_path, size=64):
+    """Decode an image folder once into a uint8 (N, 3, H, W) .npy file"""
+
+    train_data = ImageFolder(root=root_dir, transform=transforms.Compose([
+        transforms.Resize(size), transforms.CenterCrop(size),
+        transforms.PILToTensor()]))
+    data_loader = DataLoader(train_data, batch_size=256, num_workers=4)
+
+    # Written through a memory map so the dataset never has to fit in RAM,
+    # and only moved into place once complete (never a partial cache)
+    tmp_path = out_path + '.tmp'
+    imgs = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8,
+        shape=(len(train_data), 3, size, size))
+    i = 0
+    for x, _ in data_loader:
+        imgs[i:i + x.size(0)] = x.numpy()
+        i += x.size(0)
+    imgs.flush()
+    del imgs
+    os.replace(tmp_path, out_path)
+    print('Cached {:,} images to {}'.format(i, out_path))
+
+
+class CachedImages(Dataset):
+    """Decoded images memory-mapped from a build_tensor_cache file"""
+
+    def __init__(self, cache_path):
+        self.imgs = np.load(cache_path, mmap_mode='r')
+
+    def __len__(self):
+        return len(self.imgs)
+
+    def __getitem__(self, idx):
+        return torch.from_numpy(np.array(self.imgs[idx])), 0
+
+
+class EncodedImages(Dataset):
+    """Image files from an image folder, JPEGs left encoded (see decode_batch)"""
+
+    def __init__(self, root_dir):
+        self.paths = [path for path, _ in ImageFolder(root=root_dir).samples]
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, idx):
+        # Other formats (e.g. PNG) cannot go to nvJPEG, decode them here
+        data = read_file(self.paths[idx])
+        if data[:2].tolist() != [0xFF, 0xD8]:
+            data = decode_image(data, mode=ImageReadMode.RGB)
+        return data, 0
+
+
+def collate_encoded(batch):
+    """Keep encoded images (of varying byte lengths) as a list"""
+    return [data for data, _ in batch], torch.zeros(len(batch), dtype=torch.long)
+
+
+def decode_batch(data, device='cuda'):
+    """Finish decoding a list of images to a uint8 (N, 3, H, W) batch on device"""
 
-    # mean, std = [0.5066, 0.4261, 0.3836], [0.2589, 0.2380, 0.2340]
-    mean, std = [0.5] * 3, [0.5] * 3
-    normalize = transforms.Normalize(mean=mean, std=std)
-    train_data = ImageFolder(root=root_dir,
-            transform=transforms.Compose([transforms.ToTensor(), normalize]))
-    data_loader = DataLoader(train_data, batch_size=batch_size, shuffle=True)
+    # Encoded JPEGs (1-D byte tensors) are decoded together in one nvJPEG call
+    jpegs = [i for i, d in enumerate(data) if d.dim() == 1]
+    if not jpegs:
+        return torch.stack(data).to(device, non_blocking=True)
+    imgs = decode_jpeg([data[i] for i in jpegs], mode=ImageReadMode.RGB,
+        device=device)
+    for i, img in zip(jpegs, imgs):
+        data[i] = img
+    return torch.stack([d.to(device, non_blocking=True) for d in data])
+
+
+def load_dataset(root_dir, batch_size, num_workers=4, pin_memory=True,
+        cache_path=None, gpu_decode=False):
+    """Load uint8 images from image folder (see normalize)"""
+
+    collate_fn = None
+    if cache_path and os.path.isfile(cache_path):
+        # Skip JPEG/PNG decoding entirely
+        train_data = CachedImages(cache_path)
+    elif gpu_decode:
+        # Only read files here, batches are decoded on the GPU
+        train_data, collate_fn = EncodedImages(root_dir), collate_encoded
+    else:
+        train_data = ImageFolder(root=root_dir,
+                transform=transforms.PILToTensor())
+
+    # Decode in worker processes into pinned memory for async copies
+    # (prefetching more than 2 batches per worker rarely helps and costs RAM)
+    workers = {}
+    if num_workers > 0:
+        workers = dict(persistent_workers=True, prefetch_factor=2)
+    data_loader = DataLoader(train_data, batch_size=batch_size, shuffle=True,
+            drop_last=True, num_workers=num_workers, pin_memory=pin_memory,
+            collate_fn=collate_fn, **workers)
     return data_loader
 
 
+def normalize(x):
+    """Map uint8 images to normalized floats (on the images' device)"""
+
+    # x / 255 * (1 / std) - mean / std as one multiply-add, cached per device
+    if x.device not in _affine:
+        scale = torch.Tensor(STD).mul_(255).reciprocal_().view(1, -1, 1, 1)
+        shift = torch.Tensor(MEAN).div_(torch.Tensor(STD)).neg_().view(1, -1, 1, 1)
+        _affine[x.device] = (scale.to(x.device), shift.to(x.device))
+    scale, shift = _affine[x.device]
+    if x.device.type == 'cpu' and _normalize_u8 is not None:
+        # Single pass over the pixels, one table load each
+        out = torch.empty(x.shape)
+        flat = (x.size(0), x.size(1), -1)
+        _normalize_u8(x.contiguous().numpy().reshape(flat), _LUT,
+            out.numpy().reshape(flat))
+        return out
+    return torch.addcmul(shift, x.float(), scale)
+
+
 def unnormalize(img):
-    """Unnormalize image"""
+    """Unnormalize image, or batch of images, to [0, 1]"""
 
-    # mean, std = [0.5066, 0.4261, 0.3836], [0.2589, 0.2380, 0.2340]
-    #mean, std = [0.5] * 3, [0.5] * 3
-    #m = torch.Tensor(mean).view(-1, 1, 1)
-    #s = torch.Tensor(std).view(-1, 1, 1)
-    #return img.data.cpu() * s + m
-    return (img.data + 1) / 2.0
+    # img * std + mean as one multiply-add, cached per device
+    if img.device not in _inverse:
+        std = torch.Tensor(STD).view(-1, 1, 1).to(img.device)
+        mean = torch.Tensor(MEAN).view(-1, 1, 1).to(img.device)
+        _inverse[img.device] = (std, mean)
+    std, mean = _inverse[img.device]
+    return torch.addcmul(mean, img.detach(), std).clamp_(0, 1)
 
 
 def plot_error_bars():
     """ Plot error bar graph """
 
+    # Imported here to keep matplotlib out of training startup
+    import matplotlib
+    matplotlib.use('agg')
+    from matplotlib import rcParams
+    rcParams['font.family'] = 'sans-serif'
+    rcParams['font.sans-serif'] = ['Arial']
+    import matplotlib.pyplot as plt
+
     N = 2
     gan_means = (2.7355, 2.3357)
     gan_std = (0.1558, 0.1417)
@@ -154,19 +326,62 @@ def plot_error_bars():
 
 
 class AvgMeter(object):
-    """Compute and store the average and current value"""
+    """Compute and store the average (computed when read)"""
 
     def __init__(self):
         self.reset()
 
     def reset(self):
-        self.val = 0
-        self.avg = 0.
         self.sum = 0
         self.count = 0
 
     def update(self, val, n=1):
-        self.val = val
         self.sum += val * n
         self.count += n
-        self.avg = self.sum / self.count
+
+    def update_tensor(self, t):
+        """Accumulate a per-batch tensor in place on its device, no sync"""
+        if self.count == 0:
+            self.sum = t.detach().clone()
+        else:
+            self.sum.add_(t.detach())
+        self.count += 1
+
+    @property
+    def avg(self):
+        return self.sum / self.count if self.count else 0.
+
+
+class BatchTimer(object):
+    """Average time per batch, measured on the GPU timeline when available"""
+
+    def __init__(self, use_cuda=True):
+        self.use_cuda = use_cuda and torch.cuda.is_available()
+        if self.use_cuda:
+            self.start_ev = torch.cuda.Event(enable_timing=True)
+            self.end_ev = torch.cuda.Event(enable_timing=True)
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        if self.use_cuda:
+            self.start_ev.record()
+        else:
+            self.start = time.perf_counter()
+
+    def update(self, n=1):
+        self.count += n
+
+    @property
+    def avg(self):
+        """Milliseconds per batch since reset (waits for the GPU)"""
+
+        if not self.count:
+            return 0.
+        if self.use_cuda:
+            self.end_ev.record()
+            self.end_ev.synchronize()
+            elapsed = self.start_ev.elapsed_time(self.end_ev)
+        else:
+            elapsed = (time.perf_counter() - self.start) * 1000
+        return elapsed / self.count